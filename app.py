@@ -1,13 +1,20 @@
 from quart import Quart, Response, request
+from quart.datastructures import FileStorage
 from quart_cors import cors
-import json
+import gzip
+import io
+import logging
+import orjson
 import os
-import tempfile
-from werkzeug.utils import secure_filename
 import asyncio
-from supabase import create_client, Client
-from typing import Optional, Dict, Any, List, Tuple
-from autograder import process_submission
+import atexit
+import httpx
+import queue
+import weakref
+from cachetools import TTLCache
+from supabase import acreate_client, AsyncClient
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Dict, Any, List, Set, Tuple
 from dotenv import load_dotenv
 
 # Initialize app
@@ -17,25 +24,149 @@ app = cors(app, allow_origin="*")
 
 load_dotenv()
 
+# Handlers only enqueue records, after merging the message with its args
+# in the calling thread; a listener thread applies the formatter and
+# writes them, so request handlers never block on stdout
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, log_handler)
+root_logger = logging.getLogger()
+root_logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+root_logger.addHandler(QueueHandler(log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
+
+# Imported once logging is configured so the processors' start-up is logged
+from autograder import process_submission, provider_http_client
+
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_KEY = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
 
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("Missing Supabase credentials. Please set SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY environment variables.")
 
-# Initialize Supabase client
-print(f"Connecting to Supabase URL: {SUPABASE_URL}")
-print(f"Using service role key starting with: {SUPABASE_KEY[:6]}...")
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Supabase client, created once the event loop is running
+supabase: Optional[AsyncClient] = None
+SUPABASE_HTTP_LIMITS = httpx.Limits(
+    max_connections=20,
+    max_keepalive_connections=10,
+    keepalive_expiry=30.0
+)
+
+@app.before_serving
+async def init_supabase():
+    """Create the async Supabase client shared by all handlers."""
+    global supabase
+    logger.info("Connecting to Supabase URL: %s", SUPABASE_URL)
+    logger.info("Using service role key starting with: %s...", SUPABASE_KEY[:6])
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+    
+    # PostgREST already speaks HTTP/2, but httpx drops idle connections
+    # after 5s by default; keep them alive longer so bursts of requests
+    # reuse one connection instead of paying a new TLS handshake
+    postgrest = supabase.postgrest
+    default_session = postgrest.session
+    postgrest.session = httpx.AsyncClient(
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+        timeout=default_session.timeout,
+        follow_redirects=True,
+        http2=True,
+        limits=SUPABASE_HTTP_LIMITS
+    )
+    await default_session.aclose()
+
+@app.before_serving
+async def warmup_supabase():
+    """Open the first Supabase connection before any request needs it."""
+    try:
+        await supabase.table('profiles').select('user_id').limit(1).execute()
+    except Exception as e:
+        logger.warning("Supabase warmup failed: %s", e)
+
+# Strong references to tasks that outlive the request that started them
+background_tasks: Set[asyncio.Task] = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    """Run a coroutine in a task tracked until it finishes."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+@app.after_serving
+async def drain_background_tasks():
+    """Let pending status updates and streamed gradings finish on shutdown."""
+    # A finishing grading can spawn its final status update, so loop
+    while background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+
+@app.after_serving
+async def close_supabase():
+    """Close the pooled Supabase connections on shutdown."""
+    if supabase is not None:
+        await supabase.postgrest.aclose()
+
+@app.after_serving
+async def close_provider_http_client():
+    """Close the pooled Mistral/DeepSeek connections on shutdown."""
+    await provider_http_client.aclose()
+
+@app.before_serving
+async def enable_eager_tasks():
+    """Run new tasks eagerly until their first await (Python 3.12+)."""
+    if hasattr(asyncio, 'eager_task_factory'):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+
+# Passed as the full header value so Werkzeug doesn't rebuild it from a mimetype
+JSON_CONTENT_TYPE = 'application/json'
 
 def create_json_response(data: Dict[str, Any], status_code: int = 200) -> Response:
     """Helper function to create JSON responses with proper headers."""
     return Response(
-        json.dumps(data),
+        orjson.dumps(data),
         status=status_code,
-        mimetype='application/json'
+        content_type=JSON_CONTENT_TYPE
     )
 
+# JSON bodies at least this large are gzipped for clients that accept it
+COMPRESS_MIN_SIZE = 1024
+
+@app.after_request
+async def compress_response(response: Response) -> Response:
+    """Gzip large JSON responses; grading feedback compresses very well."""
+    if (
+        response.mimetype != 'application/json'
+        or request.accept_encodings['gzip'] <= 0
+        or 'Content-Encoding' in response.headers
+    ):
+        return response
+    
+    data = await response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+async def update_submission_status(submission_id: str, status: str) -> None:
+    """Set the status of a submission, logging instead of raising on failure."""
+    try:
+        await supabase.from_('submissions').update(
+            {'status': status}
+        ).eq('id', submission_id).execute()
+    except Exception as e:
+        logger.error("Error updating submission status to %s: %s", status, e)
+
+# Profiles are fetched on most page loads, so keep them briefly in memory
+PROFILE_CACHE_TTL = int(os.getenv('PROFILE_CACHE_TTL', 60))
+profile_cache = TTLCache(maxsize=10000, ttl=PROFILE_CACHE_TTL)
+profile_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
 # Test endpoint
 @app.route('/api/test', methods=['GET'])
 async def test():
@@ -54,130 +185,169 @@ async def get_profile(user_id):
                 "details": {"user_id": user_id}
             }, 400)
         
-        response = supabase.from_('profiles').select('*').eq('user_id', user_id).execute()
-        
-        if not response.data or len(response.data) == 0:
-            new_profile = {
-                'user_id': user_id,
-                'full_name': '',
-                'institution': '',
-                'department': '',
-            }
-            create_response = supabase.from_('profiles').insert(new_profile).execute()
-            if create_response.data:
-                return create_json_response({
-                    "success": True,
-                    "data": create_response.data[0],
-                    "message": "New profile created successfully"
-                })
-            return create_json_response({
-                "error": "Database error",
-                "message": "Failed to create profile",
-                "details": create_response.error if hasattr(create_response, 'error') else None
-            }, 500)
+        profile = profile_cache.get(user_id)
+        message = "Profile retrieved successfully"
+        if profile is None:
+            # On a miss only one request per user goes to Supabase; any
+            # concurrent ones wait and then read the cached row
+            async with profile_locks.setdefault(user_id, asyncio.Lock()):
+                profile = profile_cache.get(user_id)
+                if profile is None:
+                    response = await supabase.from_('profiles').select('*').eq('user_id', user_id).execute()
+                    
+                    if not response.data or len(response.data) == 0:
+                        new_profile = {
+                            'user_id': user_id,
+                            'full_name': '',
+                            'institution': '',
+                            'department': '',
+                        }
+                        create_response = await supabase.from_('profiles').insert(new_profile).execute()
+                        if not create_response.data:
+                            return create_json_response({
+                                "error": "Database error",
+                                "message": "Failed to create profile",
+                                "details": create_response.error if hasattr(create_response, 'error') else None
+                            }, 500)
+                        profile = create_response.data[0]
+                        message = "New profile created successfully"
+                    else:
+                        profile = response.data[0]
+                    
+                    profile_cache[user_id] = profile
             
         return create_json_response({
             "success": True,
-            "data": response.data[0],
-            "message": "Profile retrieved successfully"
+            "data": profile,
+            "message": message
         })
     except Exception as e:
-        print(f"Error in get_profile: {str(e)}")
+        logger.error("Error in get_profile: %s", e)
         return create_json_response({
             "error": "Server error",
             "message": "Failed to process profile request",
             "details": str(e)
         }, 500)
 
-# Simple file saving function
-async def save_file_to_temp(file) -> str:
-    """Save a file to a temporary location and return the path."""
-    temp_dir = tempfile.gettempdir()
-    temp_path = os.path.join(temp_dir, f"temp_{secure_filename(file.filename)}")
-    await file.save(temp_path)
-    return temp_path
+# Required grading form fields, with the message used when one is missing
+REQUIRED_GRADING_FIELDS = {
+    'gradingCriteria': "Missing grading criteria",
+    'submissionId': "Missing submission ID",
+}
+
+def validate_grading_request(form, files) -> Tuple[Optional[Response], float]:
+    """Validate a grading request in a single pass over the required fields.
+    
+    Returns (error_response, total_points); error_response is None when
+    the request is valid.
+    """
+    if not files:
+        return create_json_response({
+            "error": "Validation error",
+            "message": "No files provided",
+            "details": "Request must include files"
+        }, 400), 0
+    
+    missing = [field for field in REQUIRED_GRADING_FIELDS if field not in form]
+    if missing:
+        return create_json_response({
+            "error": "Validation error",
+            "message": REQUIRED_GRADING_FIELDS[missing[0]] if len(missing) == 1 else "Missing required fields",
+            "details": f"{', '.join(missing)} {'field is' if len(missing) == 1 else 'fields are'} required",
+            "missing": missing
+        }, 400), 0
+    
+    try:
+        total_points = float(form.get('totalPointsAvailable', 100))
+    except ValueError:
+        total_points = 100
+    
+    return None, total_points
+
+def is_force_refresh(form) -> bool:
+    """Return True if the form asks to bypass the OCR and grading caches."""
+    return form.get('forceRefresh', '').lower() in ('1', 'true', 'yes')
+
+async def read_grading_form() -> Tuple[Any, List[FileStorage]]:
+    """Read the multipart grading form, returning (form, files)."""
+    # The form MultiDict supports `in` and [] directly, so no dict copy
+    form = await request.form
+    # files.getlist returns all files uploaded under the 'files' key
+    files = (await request.files).getlist('files')
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received form data: %s", form)
+        logger.debug("Received files: %s", [f.filename for f in files])
+    logger.info("Number of files received: %d", len(files))
+    
+    return form, files
+
+async def finish_submission_status(grading_status: asyncio.Task, submission_id: str, status: str) -> None:
+    """Record the final status once the 'grading' update has landed."""
+    await grading_status
+    await update_submission_status(submission_id, status)
+
+async def run_grading(files, grading_criteria, submission_id, total_points, result_queue=None, force_refresh=False) -> List[Dict[str, Any]]:
+    """Grade a submission and record its final status, re-raising on failure."""
+    # Mark the submission as grading while the files are processed,
+    # so this round-trip overlaps with grading instead of preceding it
+    grading_status = asyncio.create_task(
+        update_submission_status(submission_id, 'grading')
+    )
+    
+    try:
+        results = await process_submission(
+            files,
+            grading_criteria,
+            submission_id,
+            total_points,
+            supabase,
+            result_queue,
+            force_refresh
+        )
+    except Exception:
+        # Update submission status to failed
+        spawn_background(finish_submission_status(grading_status, submission_id, 'failed'))
+        raise
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Results received from process_submission: %s", orjson.dumps(results, option=orjson.OPT_INDENT_2).decode())
+    logger.info("Number of results: %d", len(results))
+    
+    # Update submission status to completed without holding the response
+    spawn_background(finish_submission_status(grading_status, submission_id, 'completed'))
+    
+    return results
+
+def format_event(event: str, data: Dict[str, Any]) -> bytes:
+    """Encode a server-sent event with a JSON payload."""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
 
 # Autograder endpoint
 @app.route('/api/grade', methods=['POST'])
 async def grade_submission():
     """Handle file submission grading requests."""
     try:
-        # Extract form data
-        form = await request.form
-        files = await request.files
-        
-        # Convert form data to dictionary
-        form_data = dict(form)
-        
-        # Get all files with the key 'files' using getlist
-        files_dict = {}
-        file_counter = 0
-        # files.getlist returns all files with the same key
-        for file in files.getlist('files'):
-            files_dict[f'file_{file_counter}'] = file
-            file_counter += 1
-        
-        print(f"Received form data: {form_data}")
-        print(f"Received files: {[f.filename for f in files_dict.values()]}")
-        print(f"Number of files received: {len(files_dict)}")
-        
-        # Basic validation
-        if not files_dict:
-            return create_json_response({
-                "error": "Validation error",
-                "message": "No files provided",
-                "details": "Request must include files"
-            }, 400)
-            
-        if 'gradingCriteria' not in form_data:
-            return create_json_response({
-                "error": "Validation error",
-                "message": "Missing grading criteria",
-                "details": "gradingCriteria field is required"
-            }, 400)
-            
-        if 'submissionId' not in form_data:
-            return create_json_response({
-                "error": "Validation error",
-                "message": "Missing submission ID",
-                "details": "submissionId field is required"
-            }, 400)
+        form, files = await read_grading_form()
         
-        # Extract validated data
-        grading_criteria = form_data['gradingCriteria']
-        submission_id = form_data['submissionId']
+        error_response, total_points = validate_grading_request(form, files)
+        if error_response is not None:
+            return error_response
         
-        try:
-            total_points = float(form_data.get('totalPointsAvailable', 100))
-        except ValueError:
-            total_points = 100
-            
-        # Update submission status to grading (don't await Supabase operations)
-        try:
-            supabase.from_('submissions').update(
-                {'status': 'grading'}
-            ).eq('id', submission_id).execute()
-        except Exception as e:
-            print(f"Error updating submission status: {str(e)}")
+        grading_criteria = form['gradingCriteria']
+        submission_id = form['submissionId']
+        force_refresh = is_force_refresh(form)
 
         # Process all files concurrently
         try:
-            results = await process_submission(
-                files_dict,
+            results = await run_grading(
+                files,
                 grading_criteria,
                 submission_id,
                 total_points,
-                supabase
+                force_refresh=force_refresh
             )
             
-            print(f"Results received from process_submission: {json.dumps(results, indent=2)}")
-            print(f"Number of results: {len(results)}")
-            
-            # Update submission status to completed (don't await Supabase operations)
-            supabase.from_('submissions').update(
-                {'status': 'completed'}
-            ).eq('id', submission_id).execute()
-            
             return create_json_response({
                 "success": True,
                 "data": results,
@@ -187,12 +357,7 @@ async def grade_submission():
             
         except Exception as e:
             error_message = str(e)
-            print(f"Error processing submission: {error_message}")
-            
-            # Update submission status to failed (don't await Supabase operations)
-            supabase.from_('submissions').update(
-                {'status': 'failed'}
-            ).eq('id', submission_id).execute()
+            logger.error("Error processing submission: %s", error_message)
             
             return create_json_response({
                 "error": "Processing error",
@@ -202,13 +367,109 @@ async def grade_submission():
             
     except Exception as e:
         error_message = str(e)
-        print(f"Unexpected error in grade_submission: {error_message}")
+        logger.exception("Unexpected error in grade_submission: %s", error_message)
+        return create_json_response({
+            "error": "Server error",
+            "message": "An unexpected error occurred",
+            "details": error_message
+        }, 500)
+
+# Streaming autograder endpoint
+@app.route('/api/grade/stream', methods=['POST'])
+async def grade_submission_stream():
+    """Handle grading requests, streaming each file's result as it completes.
+    
+    Takes the same form as /api/grade and responds with server-sent events:
+    one `result` event per graded file, then a final `completed` or `failed`.
+    """
+    try:
+        form, files = await read_grading_form()
+        
+        error_response, total_points = validate_grading_request(form, files)
+        if error_response is not None:
+            return error_response
+        
+        grading_criteria = form['gradingCriteria']
+        submission_id = form['submissionId']
+        force_refresh = is_force_refresh(form)
+    except Exception as e:
+        error_message = str(e)
+        logger.exception("Unexpected error in grade_submission_stream: %s", error_message)
         return create_json_response({
             "error": "Server error",
             "message": "An unexpected error occurred",
             "details": error_message
         }, 500)
+    
+    # Upload streams are closed once this handler returns, so copy them
+    # into memory before handing them to a task that outlives it. Large
+    # uploads are spooled to disk, so read them off the event loop.
+    contents = await asyncio.gather(*(asyncio.to_thread(file.read) for file in files))
+    files = [
+        FileStorage(
+            io.BytesIO(content),
+            filename=file.filename,
+            content_type=file.content_type
+        )
+        for file, content in zip(files, contents)
+    ]
+    
+    # Grading runs in its own task so it still finishes, and the submission
+    # status is still recorded, if the client disconnects mid-stream
+    result_queue = asyncio.Queue()
+    grading = spawn_background(run_grading(
+        files,
+        grading_criteria,
+        submission_id,
+        total_points,
+        result_queue,
+        force_refresh
+    ))
+    
+    def end_stream(task):
+        # Retrieve the exception so asyncio doesn't warn when nobody awaits it
+        if not task.cancelled():
+            task.exception()
+        result_queue.put_nowait(None)
+    
+    grading.add_done_callback(end_stream)
+    
+    async def events():
+        while True:
+            result = await result_queue.get()
+            if result is None:
+                break
+            yield format_event("result", result)
+        
+        try:
+            results = await grading
+            yield format_event("completed", {
+                "success": True,
+                "status": "completed",
+                "count": len(results),
+                "message": "Grading completed successfully"
+            })
+        except Exception as e:
+            logger.error("Error processing submission: %s", e)
+            yield format_event("failed", {
+                "error": "Processing error",
+                "message": str(e),
+                "details": "Failed to process submission"
+            })
+    
+    return Response(
+        events(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache'}
+    )
 
 if __name__ == '__main__':
+    # Development server only; production runs under Hypercorn (see Procfile)
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    
     port = int(os.getenv('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True) 
\ No newline at end of file
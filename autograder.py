@@ -1,347 +1,709 @@
 import os
 import json
+import re
+import logging
 import asyncio
-import tempfile
+import io
 import PyPDF2
+import pypdfium2 as pdfium
 import base64
+import hashlib
+import random
+import time
+import threading
+import httpx
 from datetime import datetime
+from cachetools import TTLCache
+from postgrest.exceptions import APIError
 from werkzeug.utils import secure_filename
 from mistral_processor import MistralProcessor
-from deepseek_grader import DeepSeekGrader
+from deepseek_grader import DeepSeekGrader, MAX_BATCH_SUBMISSIONS, MAX_OUTPUT_TOKENS, CONTEXT_TOKENS
+from rate_limiter import AsyncTokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Requests, and prompt tokens, per minute allowed for each provider host;
+# 0 disables a limit. Semaphores cap concurrency, these cap throughput.
+# The buckets are per worker process, so with several Hypercorn workers
+# each one should get its share of the provider's limit.
+request_buckets = {
+    'api.mistral.ai': AsyncTokenBucket(float(os.getenv('MISTRAL_RPM', 300))),
+    'api.deepseek.com': AsyncTokenBucket(float(os.getenv('DEEPSEEK_RPM', 600))),
+}
+prompt_token_buckets = {
+    'api.deepseek.com': AsyncTokenBucket(float(os.getenv('DEEPSEEK_TPM', 0))),
+}
+
+async def pace_provider_request(request):
+    """Wait for the provider's rate limits before a request is sent.
+    
+    Runs for every request the SDKs send, retries included, so cached
+    gradings never spend tokens and retries can't burst past the limits.
+    """
+    host = request.url.host
+    if host in request_buckets:
+        await request_buckets[host].acquire()
+    if host in prompt_token_buckets:
+        # Roughly four characters of prompt per token
+        await prompt_token_buckets[host].acquire(len(request.content) // 4)
+
+async def adapt_provider_rate(response):
+    """Slow a provider's buckets down after a 429 and recover on success."""
+    host = response.request.url.host
+    for buckets in (request_buckets, prompt_token_buckets):
+        bucket = buckets.get(host)
+        if bucket is None:
+            continue
+        if response.status_code == 429:
+            bucket.throttle()
+        elif response.status_code < 400:
+            bucket.recover()
+
+# One HTTP/2 connection pool shared by the Mistral and DeepSeek clients, so
+# calls reuse warm connections instead of each SDK keeping its own pool.
+# Retries are left to the SDKs. Idle connections are kept for 30s rather
+# than httpx's default 5s, since gaps between a submission's OCR and
+# grading calls are often longer than that.
+provider_http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=30.0),
+    timeout=httpx.Timeout(120.0, connect=5.0),
+    event_hooks={
+        'request': [pace_provider_request],
+        'response': [adapt_provider_rate],
+    }
+)
 
 # Initialize processors
-mistral_processor = MistralProcessor()
-deepseek_grader = DeepSeekGrader()
+mistral_processor = MistralProcessor(http_client=provider_http_client)
+deepseek_grader = DeepSeekGrader(http_client=provider_http_client)
+
+# Caps on in-flight calls per provider, shared by every submission in this
+# worker process, so large uploads queue here instead of tripping provider
+# rate limits. Each Hypercorn worker has its own, so the total is this
+# times WEB_CONCURRENCY.
+MISTRAL_MAX_CONCURRENCY = int(os.getenv('MISTRAL_MAX_CONCURRENCY', 8))
+DEEPSEEK_MAX_CONCURRENCY = int(os.getenv('DEEPSEEK_MAX_CONCURRENCY', 8))
+provider_semaphores = {}
+
+# When set, original files are uploaded to this Supabase Storage bucket and
+# results keep only the object path in file_url, instead of a base64 copy
+# of the whole file in file_content
+SUBMISSION_FILES_BUCKET = os.getenv('SUBMISSION_FILES_BUCKET')
+
+# Files graded per DeepSeek request; small files share one prompt. Capped
+# so the reply still has a full single-file token allowance per file.
+GRADING_BATCH_SIZE = min(
+    max(1, int(os.getenv('GRADING_BATCH_SIZE', MAX_BATCH_SUBMISSIONS))),
+    MAX_BATCH_SUBMISSIONS
+)
+
+# Characters of submission content per DeepSeek request. Long OCR output
+# is graded on its own instead of inflating a shared prompt.
+GRADING_BATCH_CHARS = int(os.getenv('GRADING_BATCH_CHARS', 40000))
+
+# Estimated tokens of a single file DeepSeek can be sent. The default is
+# the context window less room for the reply, the system prompt and the
+# rubric; only a file that would not fit at all is cut, and its feedback
+# says so. 0 disables the cap.
+GRADING_MAX_FILE_TOKENS = int(os.getenv('GRADING_MAX_FILE_TOKENS', CONTEXT_TOKENS - MAX_OUTPUT_TOKENS - 8192))
+
+# CJK characters are roughly a token each; other text runs about three
+# characters to a token
+CJK_CHAR_RE = re.compile(r'[\u3000-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+# Result rows per Supabase insert. Rows can carry whole files as base64,
+# so very large submissions are split rather than sent as one huge request.
+RESULT_INSERT_BATCH_SIZE = max(1, int(os.getenv('RESULT_INSERT_BATCH_SIZE', 50)))
+
+# Retries for result inserts that fail before reaching Supabase. Provider
+# calls are retried by the Mistral and OpenAI SDKs themselves.
+SUPABASE_INSERT_RETRIES = int(os.getenv('SUPABASE_INSERT_RETRIES', 3))
+
+# How long Mistral has to fetch a PDF staged in the files bucket; uploads
+# wait on the Mistral semaphore, so leave room for queueing
+OCR_SIGNED_URL_TTL = int(os.getenv('OCR_SIGNED_URL_TTL', 3600))
 
-async def save_temp_file(file_data):
-    """Save file data to a temporary file and return its path.
+# Whether text extracted locally after an OCR failure is rewritten by
+# Mistral before grading. Off by default: the grader reads the raw text
+# fine, and the rewrite is a batch job that can take minutes.
+REWRITE_FALLBACK_TEXT = os.getenv('REWRITE_FALLBACK_TEXT', 'false').lower() in ('1', 'true', 'yes')
+
+# Mistral OCR text keyed by the sha256 of the PDF, so re-uploaded files
+# skip both the upload and the OCR call
+ocr_cache = TTLCache(
+    maxsize=int(os.getenv('OCR_CACHE_SIZE', 500)),
+    ttl=int(os.getenv('OCR_CACHE_TTL', 86400))
+)
+
+# pdfium must only be called from one thread at a time
+pdfium_lock = threading.Lock()
+
+def provider_semaphore(name, limit):
+    """Return the shared semaphore for a provider.
     
-    Handles both file objects (with filename attribute) and 
-    raw text content (string) for text files.
+    Created on first use rather than at import, because on Python 3.9 a
+    semaphore binds to whichever event loop exists when it is constructed.
+    """
+    semaphore = provider_semaphores.get(name)
+    if semaphore is None:
+        semaphore = provider_semaphores[name] = asyncio.Semaphore(limit)
+    return semaphore
+
+def is_pdf_upload(file_data):
+    """Return True if file_data is an uploaded PDF, which goes through Mistral OCR."""
+    return (
+        hasattr(file_data, 'filename')
+        and hasattr(file_data, 'save')
+        and secure_filename(file_data.filename).endswith('.pdf')
+    )
+
+async def read_text_content(file_data, default_name):
+    """Return a (file_name, text) pair for non-PDF input without touching disk.
+    
+    Handles uploaded file objects as well as raw strings, dictionaries
+    and bytes. default_name is used for inputs that carry no filename.
+    """
+    if isinstance(file_data, str):
+        return f"{default_name}.txt", file_data
+    
+    elif isinstance(file_data, dict):
+        return f"{default_name}.txt", json.dumps(file_data, indent=2)
+    
+    elif hasattr(file_data, 'filename') and hasattr(file_data, 'read'):
+        # Large uploads are spooled to disk, so read off the event loop
+        file_bytes = await asyncio.to_thread(file_data.read)
+        if not file_bytes:
+            raise ValueError(f"File is empty: {file_data.filename}")
+        return secure_filename(file_data.filename), file_bytes.decode('utf-8')
+    
+    elif isinstance(file_data, (bytes, bytearray)):
+        return f"{default_name}.bin", bytes(file_data).decode('utf-8')
+    
+    else:
+        raise TypeError(f"Unsupported file data type: {type(file_data)}. Expected string, file object, dictionary, or bytes.")
+
+async def read_pdf_upload(file_data):
+    """Return a (file_name, raw_bytes) pair for an uploaded PDF.
+    
+    The bytes are read once and reused for OCR, the local text fallback and
+    the stored copy, so the PDF never goes through a temp file.
+    """
+    # Large uploads are spooled to disk, so read off the event loop
+    file_bytes = await asyncio.to_thread(file_data.read)
+    if not file_bytes:
+        raise ValueError(f"File is empty: {file_data.filename}")
+    return secure_filename(file_data.filename), file_bytes
+
+def unique_file_name(file_name, taken, counters):
+    """Return file_name, with a number added if it is already in taken.
+    
+    The returned name is added to taken. counters keeps the last number
+    used for each name, so many uploads sharing a name don't rescan
+    from _1 every time.
+    """
+    unique_name = file_name
+    if unique_name in taken:
+        name, ext = os.path.splitext(file_name)
+        counter = counters.get(file_name, 0)
+        while unique_name in taken:
+            counter += 1
+            unique_name = f"{name}_{counter}{ext}"
+        counters[file_name] = counter
+    taken.add(unique_name)
+    return unique_name
+
+def pdf_cache_key(pdf_bytes):
+    """Hash PDF bytes for the OCR cache."""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+def extract_pdf_text(pdf_bytes):
+    """Extract the text layer of a PDF.
+    
+    Uses pdfium, which is much faster than PyPDF2 on large documents,
+    and only falls back to PyPDF2 for files pdfium cannot open.
+    
+    pdfium is not thread-safe, even across documents, so its calls are
+    serialized on pdfium_lock; this runs in worker threads whenever
+    Mistral OCR fails.
+    """
+    with pdfium_lock:
+        try:
+            pdf = pdfium.PdfDocument(pdf_bytes)
+        except pdfium.PdfiumError as e:
+            logger.warning("pdfium could not open PDF, using PyPDF2: %s", e)
+            pdf = None
+        if pdf is not None:
+            try:
+                return "".join(page.get_textpage().get_text_range() + "\n" for page in pdf)
+            finally:
+                pdf.close()
+    
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+    return "".join(page.extract_text() + "\n" for page in pdf_reader.pages)
+
+async def upload_pdf_to_mistral(file_name, pdf_bytes):
+    """Stage a PDF for OCR, returning its (file_id, signed_url)."""
+    async with provider_semaphore('mistral', MISTRAL_MAX_CONCURRENCY):
+        return await mistral_processor.upload_pdf(file_name, pdf_bytes)
+
+async def stage_pdf_for_ocr(supabase, submission_id, file_name, pdf_bytes):
+    """Stage a PDF for OCR, returning its (file_id, signed_url).
+    
+    With a submission files bucket the PDF is stored there and Mistral
+    reads it through a signed URL, so its bytes are sent once for both OCR
+    and storage; file_id is then None, as there is no Mistral copy to delete.
+    """
+    if SUBMISSION_FILES_BUCKET:
+        try:
+            path = await upload_submission_file(supabase, submission_id, file_name, pdf_bytes, 'application/pdf')
+            signed = await supabase.storage.from_(SUBMISSION_FILES_BUCKET).create_signed_url(path, OCR_SIGNED_URL_TTL)
+            return None, signed['signedURL']
+        except Exception as e:
+            logger.warning("Error staging %s in storage, uploading it to Mistral: %s", file_name, e)
+    return await upload_pdf_to_mistral(file_name, pdf_bytes)
+
+async def process_pdf_with_mistral(file_name, pdf_bytes, upload=None, cache_key=None):
+    """Process PDF using Mistral's OCR and language capabilities.
+    
+    upload is the result of upload_pdf_to_mistral, or the exception it
+    raised; without one the PDF is uploaded here. OCR text is stored in
+    ocr_cache under cache_key, if given; fallback text never is.
     """
     try:
-        temp_dir = tempfile.gettempdir()
-        
-        # Check if file_data is a string (text content) or a file object
-        if isinstance(file_data, str):
-            # For text content, create a temporary file with .txt extension
-            fd, temp_path = tempfile.mkstemp(suffix='.txt', dir=temp_dir)
-            with os.fdopen(fd, 'w') as f:
-                f.write(file_data)
-            print(f"Saved string content to temporary file: {temp_path}")
-            return temp_path
-        
-        # Check if file_data is a dictionary (might be from JSON)
-        elif isinstance(file_data, dict):
-            # Convert dict to JSON string and save as .txt
-            fd, temp_path = tempfile.mkstemp(suffix='.txt', dir=temp_dir)
-            with os.fdopen(fd, 'w') as f:
-                json.dump(file_data, f, indent=2)
-            print(f"Saved dictionary content to temporary file: {temp_path}")
-            return temp_path
-        
-        # Check if file_data has the expected attributes of a file object
-        elif hasattr(file_data, 'filename') and hasattr(file_data, 'save'):
-            # Handle file object with filename attribute
-            # Get original filename but ensure it's secure
-            original_filename = secure_filename(file_data.filename)
-            # Generate a unique filename while preserving the original name
-            temp_path = os.path.join(temp_dir, original_filename)
-            # If file exists, add a number to make it unique
-            counter = 1
-            while os.path.exists(temp_path):
-                name, ext = os.path.splitext(original_filename)
-                temp_path = os.path.join(temp_dir, f"{name}_{counter}{ext}")
-                counter += 1
-            
-            # Save the file in binary mode to preserve file integrity
-            await file_data.save(temp_path)
-            
-            # Verify file was saved and is not empty
-            if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
-                raise ValueError(f"Failed to save file or file is empty: {original_filename}")
-            
-            print(f"Saved file object to temporary file: {temp_path}")
-            return temp_path
-        
-        # Handle bytes or bytearray
-        elif isinstance(file_data, (bytes, bytearray)):
-            # For binary content, create a temporary file
-            fd, temp_path = tempfile.mkstemp(suffix='.bin', dir=temp_dir)
-            with os.fdopen(fd, 'wb') as f:
-                f.write(file_data)
-            print(f"Saved binary content to temporary file: {temp_path}")
-            return temp_path
-        
-        else:
-            # Unsupported file_data type
-            raise TypeError(f"Unsupported file data type: {type(file_data)}. Expected string, file object, dictionary, or bytes.")
-            
-    except Exception as e:
-        print(f"Error saving temporary file: {str(e)}")
-        print(f"Type of file_data: {type(file_data)}")
-        if hasattr(file_data, '__dict__'):
-            print(f"File data attributes: {file_data.__dict__}")
-        raise
-
-async def process_pdf_with_mistral(file_path):
-    """Process PDF using Mistral's OCR and language capabilities."""
-    try:
+        if isinstance(upload, Exception):
+            raise upload
         # Use Mistral's OCR and document understanding
-        return await mistral_processor.process_pdf(file_path)
+        async with provider_semaphore('mistral', MISTRAL_MAX_CONCURRENCY):
+            if upload is None:
+                text_content = await mistral_processor.process_pdf(file_name, pdf_bytes)
+            else:
+                text_content = await mistral_processor.ocr_uploaded_pdf(*upload)
+        if cache_key is not None:
+            ocr_cache[cache_key] = text_content
+        return text_content
     except Exception as e:
-        print(f"Error processing PDF: {str(e)}")
-        # Fallback to PyPDF2 if Mistral OCR fails
+        logger.warning("Error processing PDF: %s", e)
+        # Fallback to local text extraction if Mistral OCR fails
         try:
-            print("Falling back to PyPDF2 for text extraction...")
-            text_content = ""
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                for page in pdf_reader.pages:
-                    text_content += page.extract_text() + "\n"
-            
-            return await mistral_processor.process_pdf_content(text_content)
+            logger.warning("Falling back to local text extraction...")
+            text_content = await asyncio.to_thread(extract_pdf_text, pdf_bytes)
+            if not REWRITE_FALLBACK_TEXT:
+                return await mistral_processor.process_pdf_content(text_content)
+            async with provider_semaphore('mistral', MISTRAL_MAX_CONCURRENCY):
+                return await mistral_processor.process_pdf_content(text_content, rewrite=True)
         except Exception as fallback_error:
-            print(f"Fallback text extraction failed: {str(fallback_error)}")
+            logger.error("Fallback text extraction failed: %s", fallback_error)
             return "Failed to extract content from PDF."
 
-async def grade_with_deepseek(content, grading_criteria, total_points_available):
-    """Grade content using DeepSeek's API."""
-    return await deepseek_grader.grade_submission(content, grading_criteria, float(total_points_available))
+def estimate_tokens(text):
+    """Roughly estimate how many tokens text costs DeepSeek."""
+    cjk_chars = sum(1 for _ in CJK_CHAR_RE.finditer(text))
+    return cjk_chars + (len(text) - cjk_chars) // 3
 
-async def store_grading_result(supabase, submission_id, file_name, file_content, grading_result):
-    """Store the grading result in Supabase."""
-    try:
-        # Prepare data for storage
-        data = {
-            "submission_id": submission_id,
-            "file_name": file_name,
-            "file_content": file_content,
-            "grading_results": grading_result,
-            "created_at": datetime.utcnow().isoformat(),
-        }
-        
-        # Insert data into Supabase (don't await this operation)
-        response = supabase.from_('submission_results').insert(data).execute()
-        
-        # Check for errors
-        if hasattr(response, 'error') and response.error:
-            print(f"Supabase error: {response.error}")
-            return None
+def truncate_for_grading(content):
+    """Return content cut to fit GRADING_MAX_FILE_TOKENS, and whether it was cut."""
+    # No character is more than a token, so short content always fits
+    if not GRADING_MAX_FILE_TOKENS or len(content) <= GRADING_MAX_FILE_TOKENS:
+        return content, False
+    tokens = estimate_tokens(content)
+    if tokens <= GRADING_MAX_FILE_TOKENS:
+        return content, False
+    return content[:len(content) * GRADING_MAX_FILE_TOKENS // tokens], True
+
+def add_truncation_note(grading_result, graded_chars):
+    """Return a copy of grading_result whose feedback says the file was cut short."""
+    note = f"This submission was too long to grade in full; only its first {graded_chars} characters were graded."
+    feedback = grading_result.get("overallFeedback")
+    return {
+        **grading_result,
+        "overallFeedback": f"{feedback}\n\n{note}" if feedback else note
+    }
+
+async def grade_batch_with_deepseek(submissions, grading_criteria, total_points_available, use_cache=True):
+    """Grade a list of (file_name, content) pairs with a single DeepSeek request."""
+    async with provider_semaphore('deepseek', DEEPSEEK_MAX_CONCURRENCY):
+        return await deepseek_grader.grade_submissions(submissions, grading_criteria, total_points_available, use_cache)
+
+def submission_file_path(submission_id, file_name):
+    """Return the storage object path for a submission's original file."""
+    return f"{submission_id}/{file_name}"
+
+async def upload_submission_file(supabase, submission_id, file_name, file_bytes, mime_type):
+    """Upload an original file to Supabase Storage and return its object path."""
+    path = submission_file_path(submission_id, file_name)
+    await supabase.storage.from_(SUBMISSION_FILES_BUCKET).upload(
+        path,
+        file_bytes,
+        {"content-type": mime_type, "upsert": "true"}
+    )
+    return path
+
+async def build_result_row(supabase, submission_id, file_name, file_bytes, mime_type, grading_result, file_url=None):
+    """Build the submission_results row for a graded file.
+    
+    The original file is uploaded to storage when a bucket is configured,
+    and embedded as a base64 data URL otherwise. file_url is the object
+    path of a copy that is already in storage, which is not uploaded again.
+    """
+    row = {
+        "submission_id": submission_id,
+        "file_name": file_name,
+        "grading_results": grading_result,
+        "created_at": datetime.utcnow().isoformat(),
+    }
+    
+    if file_url is None and SUBMISSION_FILES_BUCKET:
+        try:
+            file_url = await upload_submission_file(supabase, submission_id, file_name, file_bytes, mime_type)
+        except Exception as e:
+            logger.warning("Error uploading %s to storage, storing it inline: %s", file_name, e)
+    
+    if file_url:
+        row["file_url"] = file_url
+    else:
+        # Encoding a multi-megabyte PDF takes long enough to stall other
+        # submissions, so do it off the event loop
+        encoded = await asyncio.to_thread(base64.b64encode, file_bytes)
+        row["file_content"] = f"data:{mime_type};base64,{encoded.decode('utf-8')}"
+    return row
+
+async def insert_result_rows(supabase, rows):
+    """Insert grading result rows into Supabase with a single bulk insert.
+    
+    Requests that never reached Supabase are retried with jittered
+    exponential backoff. Anything later is not, since retrying an insert
+    that may have landed would duplicate its rows. If Supabase rejects the
+    insert, nothing was written, so the rows are inserted one by one and
+    a single bad row doesn't lose the rest. Returns the rows that could
+    not be stored, which is empty on success.
+    """
+    for attempt in range(SUPABASE_INSERT_RETRIES + 1):
+        try:
+            response = await supabase.from_('submission_results').insert(rows).execute()
             
-        return response.data
-    except Exception as e:
-        print(f"Error storing grading result: {str(e)}")
-        return None
+            # Check for errors
+            if hasattr(response, 'error') and response.error:
+                logger.error("Supabase error: %s", response.error)
+                return rows
+                
+            return []
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            if attempt == SUPABASE_INSERT_RETRIES:
+                logger.error("Error storing grading results: %s", e)
+                return rows
+            delay = min(0.5 * 2 ** attempt, 8.0) * random.uniform(0.5, 1.0)
+            logger.warning("Could not reach Supabase (%s), retrying in %.2f seconds", e, delay)
+            await asyncio.sleep(delay)
+        except APIError as e:
+            if len(rows) == 1:
+                logger.error("Error storing grading result: %s", e)
+                return rows
+            logger.warning("Supabase rejected %d result rows (%s), inserting them one by one", len(rows), e)
+            failed = await asyncio.gather(*(insert_result_rows(supabase, [row]) for row in rows))
+            return [row for rows_failed in failed for row in rows_failed]
+        except Exception as e:
+            logger.error("Error storing grading results: %s", e)
+            return rows
+
+async def store_grading_results(supabase, rows):
+    """Store grading result rows in Supabase, RESULT_INSERT_BATCH_SIZE per request.
+    
+    The chunks are inserted concurrently; returns the rows that could not
+    be stored, which is empty on success.
+    """
+    chunks = [
+        rows[i:i + RESULT_INSERT_BATCH_SIZE]
+        for i in range(0, len(rows), RESULT_INSERT_BATCH_SIZE)
+    ]
+    failed = await asyncio.gather(*(insert_result_rows(supabase, chunk) for chunk in chunks))
+    return [row for rows_failed in failed for row in rows_failed]
 
-async def process_submission(files, grading_criteria, submission_id, total_points_available, supabase):
+async def process_submission(files, grading_criteria, submission_id, total_points_available, supabase, result_queue=None, force_refresh=False):
     """Process a batch of files for grading
     
     The files parameter can be:
     - A list of file objects (with filename attribute)
     - A list of strings (text content)
     - A dictionary of file objects
+    
+    If result_queue is given, each file's result is put on it as soon as
+    that file has been graded. force_refresh skips the OCR and grading
+    caches and re-runs every file.
     """
     try:
-        print(f"Number of files received: {len(files) if files else 0}")
-        print(f"Type of files parameter: {type(files)}")
-        
-        # Save files to temp directory
-        file_paths = []
+        logger.info("Number of files received: %d", len(files) if files else 0)
+        logger.debug("Type of files parameter: %s", type(files))
         
         # Handle different types of file inputs
         if isinstance(files, dict):
             # Handle dictionary of files
-            for _, file_obj in files.items():
-                file_path = await save_temp_file(file_obj)
-                file_paths.append(file_path)
+            file_items = list(files.values())
         elif isinstance(files, list):
             # Handle list of files or strings
-            for file_item in files:
-                file_path = await save_temp_file(file_item)
-                file_paths.append(file_path)
+            file_items = files
         else:
             # Single file or string
-            file_path = await save_temp_file(files)
-            file_paths.append(file_path)
+            file_items = [files]
         
-        if not file_paths:
+        if not file_items:
             raise ValueError("No valid files were processed")
-            
-        print(f"Successfully saved {len(file_paths)} files for processing")
         
-        # Process PDFs and text files
-        pdf_contents = {}
-        text_contents = {}
+        # Convert once here rather than in every grading call
+        total_points_available = float(total_points_available)
         
-        # Separate PDF and text files
-        pdf_files = [f for f in file_paths if f.endswith('.pdf')]
-        text_files = [f for f in file_paths if not f.endswith('.pdf')]
+        # PDFs go to Mistral OCR; everything else is decoded in memory.
+        # Nothing is written to disk either way.
+        pdf_items = []
+        text_items = []
+        for file_item in file_items:
+            (pdf_items if is_pdf_upload(file_item) else text_items).append(file_item)
         
-        # Process PDFs if any
-        if pdf_files:
-            try:
-                for pdf_file in pdf_files:
-                    try:
-                        pdf_content = await process_pdf_with_mistral(pdf_file)
-                        pdf_contents[os.path.basename(pdf_file)] = pdf_content
-                    except Exception as e:
-                        print(f"Error processing PDF {pdf_file}: {str(e)}")
-                        continue
-            except Exception as e:
-                print(f"Error in PDF batch processing: {str(e)}")
+        # Read each PDF once, all in parallel; the bytes are reused for OCR
+        # and storage
+        pdf_reads = await asyncio.gather(
+            *(read_pdf_upload(pdf_item) for pdf_item in pdf_items),
+            return_exceptions=True
+        )
+        # Names handed out so far, shared by PDFs and text files
+        taken_names = set()
+        name_counters = {}
+        pdf_bytes = {}
+        for pdf_item, pdf_read in zip(pdf_items, pdf_reads):
+            if isinstance(pdf_read, Exception):
+                logger.error("Error reading PDF %s: %s", pdf_item.filename, pdf_read)
+                continue
+            file_name, raw = pdf_read
+            pdf_bytes[unique_file_name(file_name, taken_names, name_counters)] = raw
+        
+        logger.info("Successfully read %d PDFs for processing", len(pdf_bytes))
         
-        # Process text files if any
-        if text_files:
-            for text_file in text_files:
-                try:
-                    with open(text_file, 'r', encoding='utf-8') as f:
-                        text_content = f.read()
-
-                    text_contents[os.path.basename(text_file)] = text_content
-                except Exception as e:
-                    print(f"Error processing text file {text_file}: {str(e)}")
-                    continue
-
-        # Combine all processed contents
-        all_contents = {**pdf_contents, **text_contents}
-        if not all_contents:
+        # Text files need no OCR, so read them first, all in parallel, and
+        # start grading them while PDFs are still with Mistral
+        text_reads = await asyncio.gather(
+            *(read_text_content(text_item, f"submission_{idx}") for idx, text_item in enumerate(text_items)),
+            return_exceptions=True
+        )
+        text_contents = {}
+        for idx, text_read in enumerate(text_reads):
+            if isinstance(text_read, Exception):
+                logger.error("Error processing text file %d: %s", idx, text_read)
+                continue
+            file_name, text_content = text_read
+            
+            # If the name is taken, add a number to make it unique
+            file_name = unique_file_name(file_name, taken_names, name_counters)
+            
+            text_contents[file_name] = text_content
+
+        # Every PDF yields content, if only a failure message, so this is
+        # known before any OCR runs
+        if not pdf_bytes and not text_contents:
             raise ValueError("No content could be extracted from any files")
 
-        processed_contents = all_contents
+        # PDFs staged in the files bucket, which are already stored
+        stored_pdfs = set()
 
-        # Helper function to grade and store a single file
-        async def grade_and_store(file_name, content):
-            start_time = datetime.now()
+        # Rows are collected as files are graded and inserted in one request
+        result_rows = []
+
+        # Helper function to record and report a single file's grading result
+        async def record_graded_file(file_name, content, grading_result):
             try:
-                print(f"Starting grading for: {file_name}")
-                # Grade the content
-                grade_start = datetime.now()
-                grading_result = await grade_with_deepseek(
-                    content,
-                    grading_criteria,
-                    total_points_available
-                )
-                grade_end = datetime.now()
-                grade_duration = (grade_end - grade_start).total_seconds()
-                print(f"Grading for {file_name} completed in {grade_duration:.2f} seconds")
-                
-                # Get original file content for storage
-                try:
-                    # Try to find the exact file path
-                    matching_files = [f for f in file_paths if os.path.basename(f) == file_name]
-                    
-                    if matching_files:
-                        original_file_path = matching_files[0]
-                    else:
-                        # If no exact match, try case-insensitive match
-                        file_name_lower = file_name.lower()
-                        matching_files = [f for f in file_paths if os.path.basename(f).lower() == file_name_lower]
-                        
-                        if matching_files:
-                            original_file_path = matching_files[0]
-                        else:
-                            # If still no match, log error and use a placeholder
-                            print(f"Warning: Could not find original file for {file_name}")
-                            # Create a placeholder file content
-                            file_content = f"data:text/plain;base64,{base64.b64encode(content.encode('utf-8')).decode('utf-8')}"
-                            
-                            # Store the result with the placeholder content
-                            store_start = datetime.now()
-                            await store_grading_result(
-                                supabase,
-                                submission_id,
-                                file_name,
-                                file_content,
-                                grading_result
-                            )
-                            store_end = datetime.now()
-                            store_duration = (store_end - store_start).total_seconds()
-                            print(f"Storing results for {file_name} completed in {store_duration:.2f} seconds")
-                            
-                            end_time = datetime.now()
-                            total_duration = (end_time - start_time).total_seconds()
-                            print(f"Total processing for {file_name} completed in {total_duration:.2f} seconds")
-                            
-                            return {
-                                "fileName": file_name,
-                                **grading_result
-                            }
-                    
-                    # Read the file content
-                    with open(original_file_path, 'rb') as file:
-                        file_bytes = file.read()
-                        mime_type = 'application/pdf' if file_name.endswith('.pdf') else 'text/plain'
-                        file_content = f"data:{mime_type};base64,{base64.b64encode(file_bytes).decode('utf-8')}"
-                
-                except Exception as file_error:
-                    print(f"Error reading original file for {file_name}: {str(file_error)}")
-                    # Create a placeholder file content
-                    file_content = f"data:text/plain;base64,{base64.b64encode(content.encode('utf-8')).decode('utf-8')}"
-
-                # Store the result
-                store_start = datetime.now()
-                await store_grading_result(
+                # Store the original file alongside the result; PDF bytes were
+                # kept from the upload and text content round-trips to the
+                # original bytes
+                if file_name in pdf_bytes:
+                    file_bytes, mime_type = pdf_bytes[file_name], 'application/pdf'
+                else:
+                    file_bytes, mime_type = content.encode('utf-8'), 'text/plain'
+
+                result_rows.append(await build_result_row(
                     supabase,
                     submission_id,
                     file_name,
-                    file_content,
-                    grading_result
-                )
-                store_end = datetime.now()
-                store_duration = (store_end - store_start).total_seconds()
-                print(f"Storing results for {file_name} completed in {store_duration:.2f} seconds")
-                
-                end_time = datetime.now()
-                total_duration = (end_time - start_time).total_seconds()
-                print(f"Total processing for {file_name} completed in {total_duration:.2f} seconds")
-                
-                return {
+                    file_bytes,
+                    mime_type,
+                    grading_result,
+                    submission_file_path(submission_id, file_name) if file_name in stored_pdfs else None
+                ))
+                result = {
                     "fileName": file_name,
                     **grading_result
                 }
+                logger.info("Graded %s: %s points", file_name, grading_result.get("totalScore"))
             except Exception as e:
-                end_time = datetime.now()
-                total_duration = (end_time - start_time).total_seconds()
-                print(f"Error processing {file_name} after {total_duration:.2f} seconds: {str(e)}")
-                return {
+                logger.error("Error processing %s: %s", file_name, e)
+                result = {
                     "fileName": file_name,
                     "error": str(e)
                 }
+            
+            if result_queue is not None:
+                await result_queue.put(result)
+            return result
 
-        # Create grading tasks for all files
-        print(f"Creating {len(processed_contents)} grading tasks for concurrent processing")
-        grading_tasks = []
-        for file_name, content in processed_contents.items():
-            # We don't call the coroutine here, just reference it to create a task
-            # This is the key difference - we're not awaiting it yet
-            task = grade_and_store(file_name, content)
-            grading_tasks.append(task)
+        # Grade a batch of files in one DeepSeek call, then record each result
+        async def grade_batch(batch):
+            file_names = [file_name for file_name, _ in batch]
+            logger.debug("Starting grading for: %s", file_names)
+            # A file too long for the context window is graded on as much
+            # as fits; the full content is still what gets stored
+            to_grade = []
+            truncated = {}
+            for file_name, content in batch:
+                content, was_truncated = truncate_for_grading(content)
+                if was_truncated:
+                    logger.warning("%s is too long to grade in full, grading its first %d characters", file_name, len(content))
+                    truncated[file_name] = len(content)
+                to_grade.append((file_name, content))
+            grade_start = time.perf_counter()
+            try:
+                grading_results = await grade_batch_with_deepseek(
+                    to_grade,
+                    grading_criteria,
+                    total_points_available,
+                    use_cache=not force_refresh
+                )
+            except Exception as e:
+                logger.error("Error grading %s: %s", ', '.join(file_names), e)
+                results = [{"fileName": file_name, "error": str(e)} for file_name in file_names]
+                if result_queue is not None:
+                    for result in results:
+                        await result_queue.put(result)
+                return results
+            logger.debug("Grading for %s completed in %.2f seconds", file_names, time.perf_counter() - grade_start)
+            
+            # Results may be shared with the grading cache, so notes go on a copy
+            return await asyncio.gather(*[
+                record_graded_file(
+                    file_name,
+                    content,
+                    add_truncation_note(grading_result, truncated[file_name]) if file_name in truncated else grading_result
+                )
+                for (file_name, content), grading_result in zip(batch, grading_results)
+            ])
+
+        # OCR and grading overlap: each file's content goes on grade_queue
+        # as soon as it is ready, and workers grade whatever is waiting, up
+        # to GRADING_BATCH_SIZE files and GRADING_BATCH_CHARS characters
+        # per request
+        grade_queue = asyncio.Queue()
+        no_more_content = object()
+
+        async def grade_worker():
+            results = []
+            item = await grade_queue.get()
+            while item is not no_more_content:
+                batch = [item]
+                batch_chars = len(item[1])
+                item = None
+                while len(batch) < GRADING_BATCH_SIZE and not grade_queue.empty():
+                    item = grade_queue.get_nowait()
+                    if item is no_more_content:
+                        break
+                    if batch_chars + len(item[1]) > GRADING_BATCH_CHARS:
+                        break
+                    batch.append(item)
+                    batch_chars += len(item[1])
+                    item = None
+                results.extend(await grade_batch(batch))
+                if item is None:
+                    item = await grade_queue.get()
+            # Leave the marker for the other workers
+            grade_queue.put_nowait(no_more_content)
+            return results
+
+        file_count = len(pdf_bytes) + len(text_contents)
+        logger.info("Grading %d files as their content becomes ready", file_count)
+        start_time = time.perf_counter()
+        for item in text_contents.items():
+            grade_queue.put_nowait(item)
+        workers = [
+            asyncio.create_task(grade_worker())
+            for _ in range(min(DEEPSEEK_MAX_CONCURRENCY, file_count))
+        ]
         
-        # Run all grading tasks concurrently
-        print(f"Running {len(grading_tasks)} grading tasks concurrently")
-        start_time = datetime.now()
-        results = await asyncio.gather(*grading_tasks, return_exceptions=True)
-        end_time = datetime.now()
-        duration = (end_time - start_time).total_seconds()
-        print(f"Completed concurrent grading in {duration:.2f} seconds")
+        try:
+            # PDFs seen before reuse their OCR text
+            ocr_keys = dict(zip(pdf_bytes, await asyncio.gather(
+                *(asyncio.to_thread(pdf_cache_key, raw) for raw in pdf_bytes.values())
+            )))
+            # Identical PDFs within the submission are only OCR'd once
+            names_by_key = {}
+            for file_name, cache_key in ocr_keys.items():
+                names_by_key.setdefault(cache_key, []).append(file_name)
+            pending_pdfs = []
+            for cache_key, file_names in names_by_key.items():
+                if not force_refresh and cache_key in ocr_cache:
+                    for file_name in file_names:
+                        grade_queue.put_nowait((file_name, ocr_cache[cache_key]))
+                else:
+                    pending_pdfs.append((file_names[0], pdf_bytes[file_names[0]]))
+            
+            # Process PDFs if any. Every PDF is uploaded before any OCR starts,
+            # so the uploads overlap instead of each waiting on the last OCR.
+            if pending_pdfs:
+                uploads = await asyncio.gather(
+                    *(stage_pdf_for_ocr(supabase, submission_id, file_name, raw) for file_name, raw in pending_pdfs),
+                    return_exceptions=True
+                )
+                stored_pdfs.update(
+                    file_name for (file_name, _), upload in zip(pending_pdfs, uploads)
+                    if not isinstance(upload, Exception) and upload[0] is None
+                )
+                
+                async def ocr_and_queue(file_name, raw, upload):
+                    cache_key = ocr_keys[file_name]
+                    text_content = await process_pdf_with_mistral(file_name, raw, upload, cache_key)
+                    for same_pdf in names_by_key[cache_key]:
+                        grade_queue.put_nowait((same_pdf, text_content))
+                
+                await asyncio.gather(*(
+                    ocr_and_queue(file_name, raw, upload)
+                    for (file_name, raw), upload in zip(pending_pdfs, uploads)
+                ))
+        except BaseException:
+            # Don't leave workers grading for a submission that has failed
+            for worker in workers:
+                worker.cancel()
+            raise
+        # Let the workers finish what is queued, then stop
+        grade_queue.put_nowait(no_more_content)
+        
+        results = await asyncio.gather(*workers, return_exceptions=True)
+        logger.info("Completed OCR and grading in %.2f seconds", time.perf_counter() - start_time)
         
         # Process results and handle any exceptions
         final_results = []
         for result in results:
             if isinstance(result, Exception):
-                print(f"Error in concurrent processing: {str(result)}")
+                logger.error("Error in concurrent processing: %s", result)
             else:
-                final_results.append(result)
+                final_results.extend(result)
+        # Report files in upload order, PDFs first, whatever order they finished in
+        upload_order = {file_name: i for i, file_name in enumerate([*pdf_bytes, *text_contents])}
+        final_results.sort(key=lambda result: upload_order.get(result["fileName"], len(upload_order)))
         
-        # Clean up temp files
-        for file_path in file_paths:
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                print(f"Error removing temp file {file_path}: {str(e)}")
+        # Store the graded files' rows in concurrent bulk inserts
+        if result_rows:
+            store_start = time.perf_counter()
+            unsaved = await store_grading_results(supabase, result_rows)
+            # Nothing was saved, so fail the submission as a whole
+            if unsaved and len(unsaved) == len(result_rows):
+                raise RuntimeError("Could not store grading results")
+            # Otherwise the rows that were saved stay, and each file whose
+            # row wasn't is reported with an error, so a resubmission is
+            # not needed for the rest
+            unsaved_names = {row["file_name"] for row in unsaved}
+            for result in final_results:
+                if result["fileName"] in unsaved_names:
+                    result["error"] = "Grading result could not be saved"
+                    if result_queue is not None:
+                        await result_queue.put(result)
+            logger.info("Storing %d results completed in %.2f seconds", len(result_rows), time.perf_counter() - store_start)
         
         return final_results
     except Exception as e:
-        print(f"Error in submission processing: {str(e)}")
+        logger.error("Error in submission processing: %s", e)
         raise e 
\ No newline at end of file
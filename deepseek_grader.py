@@ -1,37 +1,33 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
 import os
-import json
-from typing import Dict, Any
+import logging
+import orjson
+import hashlib
+from cachetools import TTLCache
+from typing import Dict, Any, List, Optional, Tuple
 from dotenv import load_dotenv
-import asyncio
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Submissions shorter than this, ignoring surrounding whitespace, get a
+# zero score without a DeepSeek call; there is nothing to grade
+MIN_GRADABLE_CHARS = int(os.getenv('MIN_GRADABLE_CHARS', 20))
+
+# Completion tokens allowed per graded submission, and deepseek-chat's
+# output limit. A batched reply needs the full allowance for every
+# submission, so no more than MAX_BATCH_SUBMISSIONS share one request.
+MAX_TOKENS_PER_SUBMISSION = 2000
+MAX_OUTPUT_TOKENS = 8192
+# deepseek-chat's context window, prompt and reply together
+CONTEXT_TOKENS = 65536
+MAX_BATCH_SUBMISSIONS = MAX_OUTPUT_TOKENS // MAX_TOKENS_PER_SUBMISSION
 
 class DeepSeekGrader:
-    def __init__(self):
-        """Initialize the DeepSeek grader with API credentials."""
-        load_dotenv()
-        self.api_key = os.getenv('DEEPSEEK_API_KEY')
-        if not self.api_key:
-            raise ValueError("Missing DEEPSEEK_API_KEY environment variable")
-            
-        print(f"Initializing DeepSeek client with API key starting with: {self.api_key[:4]}...")
-        self.client = OpenAI(
-            api_key=self.api_key,
-            base_url="https://api.deepseek.com"
-        )
-    
-    async def grade_submission(self, content: str, grading_criteria: str, total_points_available: float) -> Dict[str, Any]:
-        """Grade content using DeepSeek's API."""
-        try:
-            # Use run_in_executor to run the synchronous OpenAI call in a thread pool
-            # This allows multiple API calls to happen concurrently without blocking
-            loop = asyncio.get_event_loop()
-            
-            # Define the API call as a separate function for clarity
-            def make_api_call():
-                return self.client.chat.completions.create(
-                    model="deepseek-chat",
-                    messages=[
-                        {"role": "system", "content": """You are an expert grader. When grading submissions, first analyze the content and criteria carefully, then provide your response in two sections:
+    # The system prompts never change, so they are built once. Keeping
+    # everything ahead of the rubric identical between calls also lets
+    # DeepSeek's prefix cache serve it instead of reprocessing it.
+    _SYSTEM_MESSAGE = {"role": "system", "content": """You are an expert grader. When grading submissions, first analyze the content and criteria carefully, then provide your response in two sections:
 
 <reasoning>
 1. Break down each aspect/question from the grading criteria
@@ -56,8 +52,90 @@ class DeepSeekGrader:
 </response>
 
 Your JSON response must be within the <response> tags and follow the exact format shown above.
-Be thorough in your grading and provide specific, actionable feedback for each aspect."""},
-                        {"role": "user", "content": f"""Please grade this submission according to the following rubric:
+Be thorough in your grading and provide specific, actionable feedback for each aspect."""}
+    
+    _BATCH_SYSTEM_MESSAGE = {"role": "system", "content": """You are an expert grader. You will receive several independent submissions to grade against the same rubric. Grade each one on its own merits, then provide your response in two sections:
+
+<reasoning>
+For each submission in turn, break down the grading criteria, evaluate how well it meets each criterion, and justify point allocations, considering partial credit where appropriate.
+</reasoning>
+
+<response>
+{
+    "resultsPerFile": [
+        {
+            "results": [
+                {
+                    "question": "Question/Aspect being graded [point value]",
+                    "mistakes": ["List of specific mistakes or areas for improvement"],
+                    "score": number (based on rubric point allocation),
+                    "feedback": "Detailed, constructive feedback explaining point allocation"
+                }
+            ],
+            "totalScore": number (sum of all scores),
+            "overallFeedback": "Comprehensive overall feedback with suggestions for improvement"
+        }
+    ]
+}
+</response>
+
+"resultsPerFile" must contain exactly one entry per submission, in the same order as the submissions.
+Your JSON response must be within the <response> tags and follow the exact format shown above."""}
+    
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None):
+        """Initialize the DeepSeek grader with API credentials.
+        
+        http_client, if given, is used for all requests instead of a
+        client-owned connection pool.
+        """
+        load_dotenv()
+        self.api_key = os.getenv('DEEPSEEK_API_KEY')
+        if not self.api_key:
+            raise ValueError("Missing DEEPSEEK_API_KEY environment variable")
+            
+        logger.info("Initializing DeepSeek client with API key starting with: %s...", self.api_key[:4])
+        self.client = AsyncOpenAI(
+            api_key=self.api_key,
+            base_url="https://api.deepseek.com",
+            # The client retries 429s, 5xxs and connection errors with
+            # jittered exponential backoff before giving up
+            max_retries=int(os.getenv('DEEPSEEK_MAX_RETRIES', 3)),
+            http_client=http_client
+        )
+        
+        # Re-submissions and shared starter code produce identical prompts;
+        # reuse their parsed results instead of paying for another call
+        self._cache = TTLCache(
+            maxsize=int(os.getenv('GRADING_CACHE_SIZE', 1000)),
+            ttl=int(os.getenv('GRADING_CACHE_TTL', 86400))
+        )
+    
+    def _cache_key(self, content: str, grading_criteria: str, total_points_available: float) -> str:
+        """Hash the inputs that determine a grading result."""
+        return hashlib.sha256(
+            "\0".join((content, grading_criteria, str(float(total_points_available)))).encode('utf-8')
+        ).hexdigest()
+    
+    async def grade_submission(self, content: str, grading_criteria: str, total_points_available: float, use_cache: bool = True) -> Dict[str, Any]:
+        """Grade content using DeepSeek's API.
+        
+        With use_cache False a cached result is ignored, and replaced by
+        the fresh one.
+        """
+        if self._is_blank(content):
+            return self._create_empty_response()
+        
+        cache_key = self._cache_key(content, grading_criteria, total_points_available)
+        cached = self._cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            return cached
+        
+        try:
+            response = await self.client.chat.completions.create(
+                model="deepseek-chat",
+                messages=[
+                    self._SYSTEM_MESSAGE,
+                    {"role": "user", "content": f"""Please grade this submission according to the following rubric:
 
 Grading Criteria:
 {grading_criteria}
@@ -72,47 +150,143 @@ Remember to:
 2. Provide specific feedback for point deductions
 3. Consider partial credit based on the rubric
 4. Ensure total score doesn't exceed {total_points_available} points"""}
-                    ],
-                    temperature=0.3,
-                    max_tokens=2000
-                )
+                ],
+                temperature=0.3,
+                max_tokens=MAX_TOKENS_PER_SUBMISSION
+            )
+            response_content = response.choices[0].message.content
             
-            # Run the API call in a thread pool
-            response = await loop.run_in_executor(None, make_api_call)
+            try:
+                result = self._validate_result(self._extract_response_json(response_content))
+            except orjson.JSONDecodeError as json_error:
+                logger.error("JSON parsing error: %s", json_error)
+                logger.debug("Response content: %s", response_content)
+                return self._create_fallback_response(response_content, total_points_available)
             
-            return self._parse_grading_response(response.choices[0].message.content, total_points_available)
+            # Only successfully parsed results are cached, never fallbacks or errors
+            self._cache[cache_key] = result
+            return result
         except Exception as e:
-            print(f"Error grading with DeepSeek: {str(e)}")
+            logger.error("Error grading with DeepSeek: %s", e)
             return self._create_error_response(str(e))
     
-    def _parse_grading_response(self, response_content: str, total_points_available: float) -> Dict[str, Any]:
-        """Parse and validate the grading response."""
-        try:
-            # Try to extract JSON from <response> tags
-            start_tag = "<response>"
-            end_tag = "</response>"
-            start_idx = response_content.find(start_tag)
-            end_idx = response_content.find(end_tag)
-            
-            if start_idx >= 0 and end_idx > start_idx:
-                # Extract and parse JSON content
-                json_str = response_content[start_idx + len(start_tag):end_idx].strip()
-                result = json.loads(json_str)
+    async def grade_submissions(self, submissions: List[Tuple[str, str]], grading_criteria: str, total_points_available: float, use_cache: bool = True) -> List[Dict[str, Any]]:
+        """Grade several (file_name, content) submissions in one API call.
+        
+        Returns one result per submission, in order. Cached submissions are
+        not sent again unless use_cache is False, blank ones never are, and
+        identical ones are sent once. More than MAX_BATCH_SUBMISSIONS
+        uncached submissions are split across several requests.
+        """
+        results = []
+        for _, content in submissions:
+            if self._is_blank(content):
+                results.append(self._create_empty_response())
+            elif use_cache:
+                results.append(self._cache.get(self._cache_key(content, grading_criteria, total_points_available)))
             else:
-                # Fallback to looking for JSON structure if tags aren't found
-                start_idx = response_content.find('{')
-                end_idx = response_content.rfind('}') + 1
-                if start_idx >= 0 and end_idx > start_idx:
-                    json_str = response_content[start_idx:end_idx]
-                    result = json.loads(json_str)
-                else:
-                    raise ValueError("No JSON structure found in response")
-        except json.JSONDecodeError as json_error:
-            print(f"JSON parsing error: {str(json_error)}")
-            print(f"Response content: {response_content}")
-            return self._create_fallback_response(response_content, total_points_available)
+                results.append(None)
+        # Identical submissions are graded once; their result is copied to
+        # every position that shares the content
+        positions_by_content = {}
+        for i, result in enumerate(results):
+            if result is None:
+                positions_by_content.setdefault(submissions[i][1], []).append(i)
+        # One (file_name, content) pair per distinct content
+        uncached = [submissions[positions[0]] for positions in positions_by_content.values()]
+        
+        if len(uncached) == 1:
+            _, content = uncached[0]
+            graded = [await self.grade_submission(content, grading_criteria, total_points_available, use_cache)]
+        else:
+            graded = []
+            for start in range(0, len(uncached), MAX_BATCH_SUBMISSIONS):
+                graded.extend(await self._grade_batch(
+                    uncached[start:start + MAX_BATCH_SUBMISSIONS],
+                    grading_criteria,
+                    total_points_available
+                ))
+        for (_, content), result in zip(uncached, graded):
+            for i in positions_by_content[content]:
+                results[i] = result
+        
+        return results
+    
+    async def _grade_batch(self, submissions: List[Tuple[str, str]], grading_criteria: str, total_points_available: float) -> List[Dict[str, Any]]:
+        """Grade several submissions with one prompt asking for a result per submission.
+        
+        Falls back to grading each submission on its own, one after
+        another, if the batched response can't be split.
+        """
+        submission_blocks = "\n\n".join(
+            f"=== Submission {i} ({file_name}) ===\n{content}"
+            for i, (file_name, content) in enumerate(submissions, start=1)
+        )
+        try:
+            response = await self.client.chat.completions.create(
+                model="deepseek-chat",
+                messages=[
+                    self._BATCH_SYSTEM_MESSAGE,
+                    {"role": "user", "content": f"""Please grade each of the following submissions according to this rubric:
+
+Grading Criteria:
+{grading_criteria}
+
+Total Points Available (per submission): {total_points_available}
+
+There are {len(submissions)} submissions.
+
+{submission_blocks}
+
+Remember to:
+1. Grade each aspect according to its defined point values
+2. Provide specific feedback for point deductions
+3. Consider partial credit based on the rubric
+4. Ensure no submission's total score exceeds {total_points_available} points"""}
+                ],
+                temperature=0.3,
+                max_tokens=MAX_TOKENS_PER_SUBMISSION * len(submissions)
+            )
+            result = self._extract_response_json(response.choices[0].message.content)
+            per_file = result.get("resultsPerFile") if isinstance(result, dict) else None
+            if not isinstance(per_file, list) or len(per_file) != len(submissions):
+                raise ValueError(f"Expected {len(submissions)} results in batched response")
+            results = [self._validate_result(r) for r in per_file]
+            for (_, content), result in zip(submissions, results):
+                self._cache[self._cache_key(content, grading_criteria, total_points_available)] = result
+            return results
+        except Exception as e:
+            logger.warning("Batched grading failed, grading files individually: %s", e)
+            # One at a time: the caller holds a single DeepSeek concurrency
+            # slot for the whole batch. These were cache misses a moment
+            # ago, so don't look them up again.
+            results = []
+            for _, content in submissions:
+                results.append(await self.grade_submission(content, grading_criteria, total_points_available, use_cache=False))
+            return results
+    
+    def _extract_response_json(self, response_content: str) -> Any:
+        """Pull the JSON payload out of a model response."""
+        # Try to extract JSON from <response> tags. The response section
+        # comes after the reasoning, so search from the end and only scan
+        # the JSON for the closing tag.
+        start_tag = "<response>"
+        end_tag = "</response>"
+        start_idx = response_content.rfind(start_tag)
+        end_idx = response_content.find(end_tag, start_idx + len(start_tag)) if start_idx >= 0 else -1
         
-        return self._validate_result(result)
+        if start_idx >= 0 and end_idx > start_idx:
+            # Extract and parse JSON content
+            json_str = response_content[start_idx + len(start_tag):end_idx].strip()
+            return orjson.loads(json_str)
+        
+        # Fallback to looking for JSON structure if tags aren't found
+        start_idx = response_content.find('{')
+        end_idx = response_content.rfind('}') + 1
+        if start_idx >= 0 and end_idx > start_idx:
+            json_str = response_content[start_idx:end_idx]
+            return orjson.loads(json_str)
+        raise ValueError("No JSON structure found in response")
     
     def _validate_result(self, result: Dict[str, Any]) -> Dict[str, Any]:
         """Validate and ensure the grading result has the expected structure."""
@@ -145,6 +319,25 @@ Remember to:
             "overallFeedback": response_content
         }
     
+    def _is_blank(self, content: str) -> bool:
+        """Return True if content is too short to be worth grading."""
+        return len(content.strip()) < MIN_GRADABLE_CHARS
+    
+    def _create_empty_response(self) -> Dict[str, Any]:
+        """Create a zero-score response for a blank submission."""
+        return {
+            "results": [
+                {
+                    "question": "Submission evaluation",
+                    "mistakes": ["Submission is empty or too short to grade"],
+                    "score": 0,
+                    "feedback": "No gradable content was found in this submission."
+                }
+            ],
+            "totalScore": 0,
+            "overallFeedback": "No gradable content was found in this submission."
+        }
+    
     def _create_error_response(self, error_message: str) -> Dict[str, Any]:
         """Create an error response when grading fails."""
         return {
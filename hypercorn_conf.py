@@ -0,0 +1,14 @@
+"""Hypercorn settings for production, loaded by the Procfile."""
+import os
+
+bind = [f"0.0.0.0:{os.getenv('PORT', '8080')}"]
+
+# uvloop's event loop is considerably faster than the stock asyncio loop
+# on socket I/O
+worker_class = "uvloop"
+# One worker by default. Provider rate limits, concurrency caps and caches
+# all live in each worker process, so every extra worker multiplies them;
+# scale the per-provider limits down when raising this.
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+
+keep_alive_timeout = 30
@@ -1,127 +1,78 @@
 import os
-import json
+import re
+import orjson
+import logging
 import asyncio
+import httpx
 from mistralai import Mistral
+from mistralai.utils import BackoffStrategy, RetryConfig
 from dotenv import load_dotenv
-from typing import List, Dict, Any
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# OCR markdown marks each embedded image with a link to an image we never
+# request; the grader only needs to know an image was there
+IMAGE_PLACEHOLDER_RE = re.compile(r'!\[[^\]]*\]\([^)]*\)')
+
+# Retry 429s, 5xxs and connection errors with exponential backoff:
+# waits start at 1s and double up to 30s, giving up after 2 minutes
+MISTRAL_RETRY_CONFIG = RetryConfig(
+    "backoff",
+    BackoffStrategy(1000, 30000, 2.0, 120000),
+    retry_connection_errors=True
+)
 
 class MistralProcessor:
-    def __init__(self):
-        """Initialize the Mistral processor with API credentials."""
+    # Shared by every request in a text batch; orjson serializes the same
+    # dict each time rather than a fresh copy per text
+    _TEXT_SYSTEM_MESSAGE = {
+        "role": "system",
+        "content": "You are an expert at understanding and analyzing text content. Please process the following text to extract key information, maintain structure, and improve clarity."
+    }
+
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None):
+        """Initialize the Mistral processor with API credentials.
+        
+        http_client, if given, is used for all async requests instead of a
+        client-owned connection pool.
+        """
         load_dotenv()
         self.api_key = os.getenv('MISTRAL_API_KEY')
         if not self.api_key:
             raise ValueError("Missing MISTRAL_API_KEY environment variable")
             
-        print(f"Initializing Mistral client with API key starting with: {self.api_key[:4]}...")
-        self.client = Mistral(api_key=self.api_key)
-
-    async def process_pdfs_batch(self, file_paths: List[str]) -> Dict[str, str]:
-        """Process multiple PDFs using Mistral's batch API."""
-        try:
-            print(f"Processing {len(file_paths)} PDFs in batch...")
-            
-            # Create batch requests for each file
-            batch_requests = []
-            for idx, file_path in enumerate(file_paths):
-                with open(file_path, "rb") as file:
-                    # Upload each file for OCR
-                    uploaded_file = await self.client.files.upload_async(
-                        file={
-                            "file_name": os.path.basename(file_path),
-                            "content": file,
-                        },
-                        purpose="ocr"
-                    )
-                    
-                    # Get signed URL
-                    signed_url = await self.client.files.get_signed_url_async(file_id=uploaded_file.id)
-                    
-                    # Create batch request for this file
-                    batch_requests.append({
-                        "custom_id": str(idx),
-                        "body": {
-                            "model": "mistral-ocr-latest",
-                            "document": {
-                                "type": "document_url",
-                                "document_url": signed_url.url,
-                            }
-                        }
-                    })
-
-            # Create batch file
-            batch_file_content = "\n".join([json.dumps(req) for req in batch_requests])
-            
-            # Upload batch file
-            batch_data = self.client.files.upload(
-                file={
-                    "file_name": "batch_ocr.jsonl",
-                    "content": batch_file_content.encode()
-                },
-                purpose="batch"
-            )
-
-            # Create and start batch job
-            job = self.client.batch.jobs.create(
-                input_files=[batch_data.id],
-                model="mistral-ocr-latest",
-                endpoint="/v1/ocr",
-                metadata={"job_type": "pdf_ocr"}
-            )
-
-            print(f"Started batch job {job.id}")
-
-            # Poll for results
-            while True:
-                job_status = self.client.batch.jobs.get(job_id=job.id)
-                if job_status.status == "SUCCESS":
-                    results = self.client.files.download(file_id=job_status.output_file)
-                    break
-                elif job_status.status in ["FAILED", "TIMEOUT_EXCEEDED", "CANCELLED"]:
-                    raise Exception(f"Batch job failed with status: {job_status.status}")
-                await asyncio.sleep(1)  # Poll interval
-
-            # Process results
-            results_dict = {}
-            for line in results.splitlines():
-                result = json.loads(line)
-                file_idx = result["custom_id"]
-                file_path = file_paths[int(file_idx)]
-                file_name = os.path.basename(file_path)
-                
-                # Extract text from OCR response
-                ocr_text = ""
-                for page in result["response"]["pages"]:
-                    if "markdown" in page:
-                        ocr_text += page["markdown"] + "\n\n"
-                    elif "text" in page:
-                        ocr_text += page["text"] + "\n\n"
-                
-                results_dict[file_name] = ocr_text.strip()
-
-            print(f"Successfully processed {len(results_dict)} files in batch")
-            return results_dict
-
-        except Exception as e:
-            print(f"Error in batch processing: {str(e)}")
-            raise
+        logger.info("Initializing Mistral client with API key starting with: %s...", self.api_key[:4])
+        self.client = Mistral(
+            api_key=self.api_key,
+            async_client=http_client,
+            retry_config=MISTRAL_RETRY_CONFIG
+        )
+        # Strong references to fire-and-forget uploaded file deletions
+        self._cleanup_tasks = set()
 
     async def process_texts_batch(self, texts: Dict[str, str]) -> Dict[str, str]:
         """Process multiple text contents with Mistral AI in batch."""
         try:
-            print(f"Processing {len(texts)} texts in batch...")
+            logger.info("Processing %d texts in batch...", len(texts))
             
+            # Identical texts are sent once; their result is copied to every
+            # file name that shares it
+            names_by_content = {}
+            for file_name, content in texts.items():
+                names_by_content.setdefault(content, []).append(file_name)
+            # custom_id -> text, so results are matched by id rather than
+            # by their position in the output file
+            texts_by_id = {str(idx): content for idx, content in enumerate(names_by_content)}
+
             # Create batch requests
             batch_requests = []
-            for idx, (file_name, content) in enumerate(texts.items()):
+            for custom_id, content in texts_by_id.items():
                 batch_requests.append({
-                    "custom_id": str(idx),
+                    "custom_id": custom_id,
                     "body": {
                         "messages": [
-                            {
-                                "role": "system",
-                                "content": "You are an expert at understanding and analyzing text content. Please process the following text to extract key information, maintain structure, and improve clarity."
-                            },
+                            self._TEXT_SYSTEM_MESSAGE,
                             {
                                 "role": "user",
                                 "content": content
@@ -130,68 +81,147 @@ class MistralProcessor:
                     }
                 })
 
-            # Create batch file
-            batch_file_content = "\n".join([json.dumps(req) for req in batch_requests])
+            # Create batch file; orjson emits bytes, ready to upload
+            batch_file_content = b"\n".join(orjson.dumps(req) for req in batch_requests)
             
             # Upload batch file
-            batch_data = self.client.files.upload(
+            batch_data = await self.client.files.upload_async(
                 file={
                     "file_name": "batch_text.jsonl",
-                    "content": batch_file_content.encode()
+                    "content": batch_file_content
                 },
                 purpose="batch"
             )
 
             # Create and start batch job
-            job = self.client.batch.jobs.create(
+            job = await self.client.batch.jobs.create_async(
                 input_files=[batch_data.id],
                 model="mistral-large-latest",
                 endpoint="/v1/chat/completions",
                 metadata={"job_type": "text_processing"}
             )
 
-            print(f"Started batch job {job.id}")
+            logger.info("Started batch job %s", job.id)
 
-            # Poll for results
-            while True:
-                job_status = self.client.batch.jobs.get(job_id=job.id)
-                if job_status.status == "SUCCESS":
-                    results = self.client.files.download(file_id=job_status.output_file)
-                    break
-                elif job_status.status in ["FAILED", "TIMEOUT_EXCEEDED", "CANCELLED"]:
-                    raise Exception(f"Batch job failed with status: {job_status.status}")
-                await asyncio.sleep(1)  # Poll interval
+            job_status = await self._wait_for_job(job.id)
+            # download returns a streamed response; parse it line by line
+            # rather than reading the whole output file into memory
+            output = await self.client.files.download_async(file_id=job_status.output_file)
 
             # Process results
             results_dict = {}
-            file_names = list(texts.keys())
-            for line in results.splitlines():
-                result = json.loads(line)
-                file_idx = int(result["custom_id"])
-                file_name = file_names[file_idx]
-                results_dict[file_name] = result["response"]["choices"][0]["message"]["content"]
-
-            print(f"Successfully processed {len(results_dict)} texts in batch")
+            try:
+                async for line in output.aiter_lines():
+                    if not line.strip():
+                        continue
+                    result = orjson.loads(line)
+                    content = texts_by_id[result["custom_id"]]
+                    processed = result["response"]["choices"][0]["message"]["content"]
+                    for file_name in names_by_content[content]:
+                        results_dict[file_name] = processed
+            finally:
+                await output.aclose()
+
+            logger.info("Successfully processed %d texts in batch", len(results_dict))
             return results_dict
 
         except Exception as e:
-            print(f"Error in batch text processing: {str(e)}")
+            logger.error("Error in batch text processing: %s", e)
             raise
 
+    async def process_pdf(self, file_name: str, content: bytes) -> str:
+        """OCR a single PDF, given its name and raw bytes, with a direct OCR call.
+        
+        A batch job for one file costs extra uploads, job creation and
+        polling; calling the OCR endpoint directly returns in one round-trip.
+        """
+        file_id, signed_url = await self.upload_pdf(file_name, content)
+        return await self.ocr_uploaded_pdf(file_id, signed_url)
+
+    async def upload_pdf(self, file_name: str, content: bytes) -> Tuple[str, str]:
+        """Upload a PDF for OCR and return its (file_id, signed_url)."""
+        uploaded_file = await self.client.files.upload_async(
+            file={
+                "file_name": file_name,
+                "content": content,
+            },
+            purpose="ocr"
+        )
+        try:
+            signed_url = await self.client.files.get_signed_url_async(file_id=uploaded_file.id)
+        except Exception:
+            self._delete_file_in_background(uploaded_file.id)
+            raise
+        return uploaded_file.id, signed_url.url
+
+    async def ocr_uploaded_pdf(self, file_id: Optional[str], signed_url: str) -> str:
+        """OCR a PDF staged by upload_pdf, then delete the uploaded copy.
+        
+        file_id is None for a PDF hosted elsewhere, which is left alone.
+        """
+        try:
+            ocr_response = await self.client.ocr.process_async(
+                model="mistral-ocr-latest",
+                document={
+                    "type": "document_url",
+                    "document_url": signed_url,
+                }
+            )
+        finally:
+            # The uploaded copy is no longer needed; don't wait on its deletion
+            if file_id is not None:
+                self._delete_file_in_background(file_id)
+        
+        markdown = "\n\n".join(page.markdown for page in ocr_response.pages)
+        return IMAGE_PLACEHOLDER_RE.sub("[image]", markdown).strip()
+
+    async def _wait_for_job(self, job_id: str, initial: float = 1.0, factor: float = 2.0, cap: float = 30.0):
+        """Poll a batch job until it succeeds, returning its final status.
+        
+        The poll interval starts at initial seconds and grows by factor up
+        to cap, so short jobs return quickly and long ones aren't polled
+        every second. Raises if the job fails.
+        """
+        delay = initial
+        while True:
+            job_status = await self.client.batch.jobs.get_async(job_id=job_id)
+            if job_status.status == "SUCCESS":
+                return job_status
+            elif job_status.status in ["FAILED", "TIMEOUT_EXCEEDED", "CANCELLED"]:
+                raise Exception(f"Batch job failed with status: {job_status.status}")
+            await asyncio.sleep(delay)
+            delay = min(delay * factor, cap)
+
+    def _delete_file_in_background(self, file_id: str) -> None:
+        """Delete an uploaded file without blocking the caller."""
+        async def delete():
+            try:
+                await self.client.files.delete_async(file_id=file_id)
+            except Exception as e:
+                logger.warning("Error deleting uploaded file %s: %s", file_id, e)
+        
+        task = asyncio.create_task(delete())
+        self._cleanup_tasks.add(task)
+        task.add_done_callback(self._cleanup_tasks.discard)
+
     # Keep the old methods for backward compatibility and single-file processing
-    async def process_pdf(self, file_path: str) -> str:
-        """Process a single PDF using batch processing."""
-        results = await self.process_pdfs_batch([file_path])
-        return results[os.path.basename(file_path)]
 
     async def process_text(self, text_content: str) -> str:
         """Process a single text using batch processing."""
         results = await self.process_texts_batch({"text": text_content})
         return results["text"]
 
-    async def process_pdf_content(self, text_content: str) -> str:
-        """Process PDF text content with Mistral AI."""
+    async def process_pdf_content(self, text_content: str, rewrite: bool = False) -> str:
+        """Prepare text extracted locally from a PDF for grading.
+        
+        The text is returned as extracted. With rewrite it is first passed
+        through Mistral, which costs a batch job and another model pass.
+        A PDF with no text layer yields "", which is graded as blank
+        without a DeepSeek call.
+        """
         if not text_content.strip():
-            return "No text content could be extracted from the PDF."
+            return ""
         
+        if not rewrite:
+            return text_content
         return await self.process_text(text_content) 
\ No newline at end of file
@@ -0,0 +1,61 @@
+import asyncio
+import time
+from typing import Optional
+
+class AsyncTokenBucket:
+    """Token bucket that makes callers wait until enough tokens are available.
+
+    Tokens refill continuously at rate_per_minute, up to one minute's worth.
+    A rate of 0 disables the bucket. After a 429 the refill rate is halved,
+    and it creeps back towards the configured rate on each success (AIMD).
+    Buckets live in one process, so each worker has its own.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.max_rate = rate_per_minute / 60.0
+        self.rate = self.max_rate
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        # Created on first use; on Python 3.9 a lock binds to the event
+        # loop that exists when it is constructed
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: float = 1) -> None:
+        """Wait until tokens are available, then take them."""
+        if self.max_rate <= 0:
+            return
+        # A request larger than the bucket would wait forever; let it
+        # drain the bucket instead
+        tokens = min(tokens, self.capacity)
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # Waiters queue on the lock, so tokens are handed out in order
+        async with self._lock:
+            self._refill()
+            while self.tokens < tokens:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= tokens
+
+    def throttle(self) -> None:
+        """Halve the refill rate after the provider rate-limited us.
+        
+        Saved-up tokens are dropped to about a second's worth as well,
+        otherwise a full bucket would keep sending at the old pace.
+        """
+        self._refill()
+        self.rate = max(self.rate / 2, self.max_rate / 32)
+        self.tokens = min(self.tokens, self.rate)
+
+    def recover(self) -> None:
+        """Step the refill rate back towards the configured rate."""
+        if self.rate < self.max_rate:
+            self._refill()
+            self.rate = min(self.rate + self.max_rate / 16, self.max_rate)